@@ -15,14 +15,18 @@ def generate_all():
             print("timeout!")
             break
         print("looking for number: "+no)
-        ma = read_marc.read_mc(no)
-        generate_dummie(ma, no)
+        try:
+            letter = read_marc.load_letter(no)
+        except read_marc.MarcParseError as e:
+            print("skipping {}: {}".format(no, e))
+            continue
+        generate_dummie(letter, no)
         #print(ma)
         #print(read_marc.get_content_info(ma))
 
 
-def generate_dummie(marc, id):
-    date = read_marc.get_date(marc)
+def generate_dummie(letter, id):
+    date = letter['date']
     print("\ngenerating dummie for: {} ({})".format(id, date))
     tree = etree.parse("input/xml_template.xml")
     root = tree.getroot()
@@ -30,12 +34,12 @@ def generate_dummie(marc, id):
     """!!! TODO: page_id !!!"""
 
     # ad meta data to tree
-    date = read_marc.get_date(marc)
+    date = letter['date']
     title = date.replace(".", "-") + "_"
-    authors = read_marc.get_author(marc)
+    authors = letter['author']
     author_string = get_name_string(authors)
     title = title + author_string + "-"
-    recipients = read_marc.get_recipient(marc)
+    recipients = letter['recipient']
     recipient_string = get_name_string(recipients)
     title = title + recipient_string
     root.set("title", title)
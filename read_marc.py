@@ -1,4 +1,27 @@
+import json
+import os
+import struct
+import tempfile
+from collections import defaultdict
 from pymarc import MARCReader
+from pymarc.exceptions import PymarcException
+
+aleph_data_path = os.path.join("input", "aleph_data")
+
+# bump whenever the extraction changes, older letter caches are then rebuilt
+_LETTER_CACHE_VERSION = 1
+
+# (key, subfield code) pairs picked from a single field
+_DESCRIPTION = (('title', 'a'), ('author', 'c'))
+_CREATION_PLACE = (('place', 'a'), ('gnd', '0'))
+_PHYSICAL_DESCRIPTION = (('amount', 'a'), ('format', 'c'))
+_BIBLIOGRAPHICAL_INFO = (('reference', 'a'), ('type', 'i'))
+_REPRODUCTION_INFO = (('type', 'a'), ('place', 'b'), ('institution', 'c'), ('year', 'd'), ('additional', 'n'))
+
+
+class MarcParseError(Exception):
+    pass
+
 
 def read_mc_test():
     print("reading example")
@@ -9,262 +32,230 @@ def read_mc_test():
 def read_mc(sys_no):
     print("reading: "+sys_no)
     list = []
-    with open("input/aleph_data/"+sys_no+".marc", "rb") as f:
+    with open(os.path.join(aleph_data_path, sys_no + ".marc"), "rb") as f:
         print(f)
-        data = f.read()
-    #print(data)
-    reader = MARCReader(bytes(data), force_utf8=True, to_unicode=True)
-    #print(reader)
-    tmp = next(reader)
+        # hand the file to the reader so only the first record is read
+        tmp = next(iter_records(f), None)
+    if tmp is None:
+        raise MarcParseError("no MARC record found for: " + sys_no)
     print(tmp)
     #print("date:")
     #print(get_date(tmp))
     return tmp
 
-def get_date(records):
-    date = None
-    for field in records.get_fields('046'):
-        date = field['c']
-
-    return date
-
-def __check_for_gnd(marcField, GNDIndex):
+def load_letter(sys_no):
+    # the extracted dict is cached next to the .marc file and reused while it is newer
+    marc_path = os.path.join(aleph_data_path, sys_no + ".marc")
+    json_path = os.path.join(aleph_data_path, sys_no + ".json")
+    try:
+        if os.path.getmtime(json_path) >= os.path.getmtime(marc_path):
+            with open(json_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            if isinstance(cached, dict) and cached.get("version") == _LETTER_CACHE_VERSION:
+                return cached["letter"]
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        # unreadable cache file, rebuild it from the .marc
+        pass
+
+    with open(marc_path, "rb") as f:
+        letter = extract_fields(parse_marc21(f.read()))
+
+    # write to a temp file first so an interrupted dump never leaves a truncated cache,
+    # and a cache that can't be written doesn't fail a letter that was read fine
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=aleph_data_path,
+                                         prefix=sys_no + ".", suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            json.dump({"version": _LETTER_CACHE_VERSION, "letter": letter}, f, ensure_ascii=False)
+        os.replace(tmp_path, json_path)
+        tmp_path = None
+    except OSError as e:
+        print("could not write letter cache {}: {}".format(json_path, e))
+    finally:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return letter
+
+def iter_records(data):
+    # one reader for all records in a file or blob; the first broken record
+    # raises MarcParseError and ends the iteration, the records after it are not read
+    reader = MARCReader(data, force_utf8=True, to_unicode=True)
+    try:
+        for record in reader:
+            # newer pymarc versions yield None for a broken record instead of raising
+            if record is None:
+                raise MarcParseError("could not read MARC record: {}".format(getattr(reader, "current_exception", None)))
+            yield record
+    except (PymarcException, ValueError) as e:
+        raise MarcParseError("could not read MARC record: {}".format(e))
+
+def __subfields(marcField):
+    # map subfield code -> value in one pass; the first occurrence wins like marcField[code]
+    subfields = {}
+    for code, value in marcField:
+        subfields.setdefault(code, value)
+
+    return subfields
+
+def parse_marc21(buf):
+    # decode the first record straight into the index_fields layout without
+    # building pymarc objects, anything that doesn't look like MARC21 goes to pymarc
+    try:
+        length = int(buf[0:5])
+        base_address = int(buf[12:17])
+        if len(buf) < length or base_address >= length or (base_address - 25) % 12:
+            raise ValueError("malformed leader")
+
+        fields = defaultdict(list)
+        for entry in range(24, base_address - 1, 12):
+            tag, field_length, field_offset = struct.unpack_from("3s4s5s", buf, entry)
+            tag = tag.decode("ascii")
+            # control fields carry no subfields
+            if tag < '010' and tag.isdigit():
+                continue
+
+            start = base_address + int(field_offset)
+            end = start + int(field_length)
+            if end > length:
+                raise ValueError("directory entry out of range: " + tag)
+
+            subfields = {}
+            for subfield in buf[start:end - 1].split(b"\x1f")[1:]:
+                if subfield:
+                    subfields.setdefault(subfield[0:1].decode("ascii"), subfield[1:].decode("utf-8"))
+            fields[tag].append(subfields)
+
+        return fields
+    except (ValueError, struct.error):
+        record = next(iter_records(buf), None)
+        if record is None:
+            raise MarcParseError("no MARC record found in data")
+        return index_fields(record)
+
+def index_fields(records):
+    # group the fields by tag once instead of scanning the record per get_*,
+    # each field is kept as its subfield dict so every subfield is parsed once
+    fields = defaultdict(list)
+    for field in records.get_fields():
+        if not field.is_control_field():
+            fields[field.tag].append(__subfields(field))
+
+    return fields
+
+def extract_all(records):
+    return extract_fields(index_fields(records))
+
+def extract_fields(fields):
+    author, recipient = get_people(fields)
+    return {
+        'date': get_date(fields),
+        'author': author,
+        'recipient': recipient,
+        'mentioned_persons': get_mentioned_persons(fields),
+        'description': get_description(fields),
+        'creation_form': get_creation_form(fields),
+        'creation_place': get_creation_place(fields),
+        'physical_description': get_physical_description(fields),
+        'footnote': get_footnote(fields),
+        'bibliographical_info': get_bibliographical_info(fields),
+        'content_info': get_content_info(fields),
+        'accompanying_material': get_accompanying_material(fields),
+        'reproduction_info': get_reproduction_info(fields),
+        'language': get_language(fields),
+        'bernoulli_work_reference': get_bernoulli_work_reference(fields),
+        'emanuscript_link': get_emanuscript_link(fields)
+    }
 
-    if marcField['d'] is not None:
-        date = marcField['d']
-    else:
-        date = ""
+def get_date(fields):
+    return next((field['c'] for field in fields.get('046', ()) if 'c' in field), None)
 
-    if marcField[GNDIndex] is None:
-        GND = 'no_GND'
-    else:
+def __check_for_gnd(subfields, GNDIndex):
+    return {
         # get rid of trailing comma
-        GND = marcField[GNDIndex].replace(',', '')
+        "GND": subfields.get(GNDIndex, 'no_GND').rstrip(','),
+        "name": subfields.get('a'),
+        "date": subfields.get('d', ""),
+        "role": subfields.get('4', "")
+    }
 
-    role = ""
-    if marcField['4'] is not None:
-        role = marcField['4']
+def __collect_subfields(fields, tag, spec):
+    # merge the keys over all repeated fields, the first value per key wins
+    collected = {}
+    for field in fields.get(tag, ()):
+        for key, code in spec:
+            if key not in collected and code in field:
+                collected[key] = field[code]
 
-    return {
-        "GND": GND,
-        "name": marcField['a'],
-        "date": date,
-        "role": role
-    }
+    return collected or None
 
-def get_author(records):
+def get_people(fields):
+    # sort the 700 fields into authors and recipients in a single pass
     author = []
-    for field in records.get_fields('100'):
+    for field in fields.get('100', ()):
         author.append(__check_for_gnd(field, '0'))
 
-    # check for 700 that are actually authors
-    for field in records.get_fields('700'):
+    recipient = []
+    for field in fields.get('700', ()):
         person = __check_for_gnd(field, '0')
 
         if person['role'] == "aut":
             author.append(person)
+        elif person['role'] == "rcp":
+            recipient.append(person)
 
-    return author
-
-def get_recipient(records):
-    recipient = []
-    for field in records.get_fields('700'):
-        person = __check_for_gnd(field, '0')
+    return author, recipient
 
-        if person['role'] == "rcp":
-            recipient.append(person)
+def get_author(fields):
+    return get_people(fields)[0]
 
-    return recipient
+def get_recipient(fields):
+    return get_people(fields)[1]
 
-def get_mentioned_persons(records):
+def get_mentioned_persons(fields):
     mentioned = []
-    for field in records.get_fields('600'):
+    for field in fields.get('600', ()):
         mentioned.append(__check_for_gnd(field, '0'))
 
     return mentioned
 
-def get_description(records):
-    description = None
-    for field in records.get_fields('245'):
-        if 'a' in field:
-            description = {
-                'title': field['a']
-            }
-
-        if 'c' in field:
-            if description is not None:
-                description.update({
-                    'author': field['c']
-                })
-            else:
-                description = {
-                    'author': field['c']
-                }
-
-    return description
-
-def get_creation_form(records):
-    creation_information = None
-    for field in records.get_fields('250'):
-        if 'a' in field:
-            creation_information = field['a']
-
-    return creation_information
-
-def get_creation_place(records):
-    creation_place = None
-    for field in records.get_fields('751'):
-        if 'a' in field:
-            creation_place = {
-                'place': field['a']
-            }
-        if '0' in field:
-            if creation_place is not None:
-                creation_place.update({
-                    'gnd': field['0']
-                })
-            else:
-                creation_place = {
-                    'gnd': field['0']
-                }
-
-
-    return creation_place
-
-def get_physical_description(records):
-    physical_description = None
-    for field in records.get_fields('300'):
-        if 'a' in field:
-            physical_description = {
-                'amount': field['a']
-            }
-
-        if 'c' in field:
-            if physical_description is not None:
-                physical_description.update({
-                    'format': field['c']
-                })
-            else:
-                physical_description = {
-                    'format': field['c']
-                }
-
-    return physical_description
-
-def get_footnote(records):
-    footnote = None
-    for field in records.get_fields('500'):
-        if 'a' in field:
-            footnote = field['a']
-
-    return footnote
-
-def get_bibliographical_info(records):
-    bibliographical_info = None
-    for field in records.get_fields('510'):
-        if 'a' in field:
-            bibliographical_info = {
-                'reference': field['a']
-            }
-
-        if 'i' in field:
-            if bibliographical_info is not None:
-                bibliographical_info.update({
-                    'type': field['i']
-                })
-            else:
-                bibliographical_info = {
-                    'type': field['i']
-                }
-
-    return bibliographical_info
-
-def get_content_info(records):
-    content_info = None
-    for field in records.get_fields('520'):
-        if 'a' in field:
-            content_info = field['a']
-
-    return content_info
-
-def get_accompanying_material(records):
-    accompanying_material = None
-    for field in records.get_fields('525'):
-        if 'a' in field:
-            accompanying_material = field['a']
-
-    return accompanying_material
-
-def get_reproduction_info(records):
-    reproduction_info = None
-    for field in records.get_fields('533'):
-        if 'a' in field:
-            reproduction_info = {
-                'type': field['a']
-            }
-
-        if 'b' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'place': field['b']
-                })
-            else:
-                reproduction_info = {
-                    'place': field['b']
-                }
-
-        if 'c' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'institution': field['c']
-                })
-            else:
-                reproduction_info = {
-                    'institution': field['c']
-                }
-
-        if 'd' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'year': field['d']
-                })
-            else:
-                reproduction_info = {
-                    'year': field['d']
-                }
-
-        if 'n' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'additional': field['n']
-                })
-            else:
-                reproduction_info = {
-                    'additional': field['n']
-                }
-
-    return reproduction_info
-
-def get_language(records):
-    language = None
-    for field in records.get_fields('546'):
-        if 'a' in field:
-            language = field['a']
-
-    return language
-
-def get_bernoulli_work_reference(records):
-    bernoulli_work_reference = None
-    for field in records.get_fields('596'):
-        if 'a' in field:
-            bernoulli_work_reference = field['a']
-
-    return bernoulli_work_reference
-
-def get_emanuscript_link(records):
-    emanuscript_link = None
-    for field in records.get_fields('856'):
-        if 'u' in field:
-            emanuscript_link = field['u']
-
-    return emanuscript_link
+def get_description(fields):
+    return __collect_subfields(fields, '245', _DESCRIPTION)
+
+def get_creation_form(fields):
+    return next((field['a'] for field in fields.get('250', ()) if 'a' in field), None)
+
+def get_creation_place(fields):
+    return __collect_subfields(fields, '751', _CREATION_PLACE)
+
+def get_physical_description(fields):
+    return __collect_subfields(fields, '300', _PHYSICAL_DESCRIPTION)
+
+def get_footnote(fields):
+    return next((field['a'] for field in fields.get('500', ()) if 'a' in field), None)
+
+def get_bibliographical_info(fields):
+    return __collect_subfields(fields, '510', _BIBLIOGRAPHICAL_INFO)
+
+def get_content_info(fields):
+    return next((field['a'] for field in fields.get('520', ()) if 'a' in field), None)
+
+def get_accompanying_material(fields):
+    return next((field['a'] for field in fields.get('525', ()) if 'a' in field), None)
+
+def get_reproduction_info(fields):
+    return __collect_subfields(fields, '533', _REPRODUCTION_INFO)
+
+def get_language(fields):
+    return next((field['a'] for field in fields.get('546', ()) if 'a' in field), None)
+
+def get_bernoulli_work_reference(fields):
+    return next((field['a'] for field in fields.get('596', ()) if 'a' in field), None)
+
+def get_emanuscript_link(fields):
+    return next((field['u'] for field in fields.get('856', ()) if 'u' in field), None)
@@ -0,0 +1,82 @@
+import os
+import unittest
+from unittest import mock
+
+from pymarc import MARCReader
+
+import read_marc
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "input", "aleph_data", "000054744.marc")
+
+
+def build_marc(fields):
+    # minimal MARC21 encoder: fields is a list of (tag, field bytes without the terminator)
+    directory = b""
+    data = b""
+    for tag, body in fields:
+        body += b"\x1e"
+        directory += tag.encode("ascii") + b"%04d%05d" % (len(body), len(data))
+        data += body
+    directory += b"\x1e"
+    base_address = 24 + len(directory)
+    length = base_address + len(data) + 1
+    leader = b"%05dnam a22%05d   4500" % (length, base_address)
+    return leader + directory + data + b"\x1d"
+
+
+def pymarc_index(buf):
+    return read_marc.index_fields(next(MARCReader(buf, force_utf8=True, to_unicode=True)))
+
+
+class ParseMarc21Test(unittest.TestCase):
+
+    def setUp(self):
+        with open(SAMPLE, "rb") as f:
+            self.sample = f.read()
+
+    def test_sample_matches_pymarc(self):
+        self.assertEqual(read_marc.parse_marc21(self.sample), pymarc_index(self.sample))
+
+    def test_control_fields_are_skipped(self):
+        fields = read_marc.parse_marc21(self.sample)
+        self.assertNotIn('003', fields)
+        self.assertNotIn('008', fields)
+        self.assertIn('046', fields)
+
+    def test_first_subfield_wins_and_utf8_is_decoded(self):
+        buf = build_marc([
+            ('001', b"000000001"),
+            ('700', "1 \x1faMüller, Johann\x1faSecond\x1f4rcp".encode("utf-8")),
+            ('700', b"1 \x1faBernoulli\x1f4aut")
+        ])
+        fields = read_marc.parse_marc21(buf)
+        self.assertEqual(fields, pymarc_index(buf))
+        self.assertEqual(fields['700'][0], {'a': "Müller, Johann", '4': 'rcp'})
+
+    def test_out_of_range_entry_falls_back_to_pymarc(self):
+        buf = bytearray(build_marc([('245', b"10\x1faTitle"), ('500', b"  \x1faNote")]))
+        # point the 500 entry past the end of the record
+        buf[24 + 12 + 7:24 + 12 + 12] = b"09999"
+        buf = bytes(buf)
+        with mock.patch.object(read_marc, 'iter_records', wraps=read_marc.iter_records) as fallback:
+            fields = read_marc.parse_marc21(buf)
+        fallback.assert_called_once_with(buf)
+        self.assertEqual(fields, pymarc_index(buf))
+
+    def test_truncated_buffer_raises(self):
+        with self.assertRaises(read_marc.MarcParseError):
+            read_marc.parse_marc21(self.sample[:100])
+
+    def test_empty_buffer_raises(self):
+        with self.assertRaises(read_marc.MarcParseError):
+            read_marc.parse_marc21(b"")
+
+    def test_bad_utf8_raises(self):
+        start = self.sample.index(b"Brief an einen")
+        buf = self.sample[:start] + b"\xff" + self.sample[start + 1:]
+        with self.assertRaises(read_marc.MarcParseError):
+            read_marc.parse_marc21(buf)
+
+
+if __name__ == '__main__':
+    unittest.main()